@@ -30,25 +30,33 @@ THE SOFTWARE.
 """
 
 import abc
-import itertools
 import logging
+import sys
 from dataclasses import dataclass, field
-from typing import Any, Callable, Dict, FrozenSet, Mapping, Tuple, Type
+from functools import lru_cache, partial
+from typing import (
+    TYPE_CHECKING, Any, Callable, Dict, FrozenSet, Iterator, List, Mapping, Tuple,
+    Type)
 
 import numpy as np
-from pyrsistent import PMap, pmap
 
 import pytato as pt
-from pytools import ProcessLogger
+from pytools import ProcessLogger, memoize_method
 from pytools.tag import Tag
 
-from arraycontext.container import ArrayContainer, is_array_container_type
+from arraycontext.container import (
+    ArrayContainer, NotAnArrayContainerError, is_array_container_type,
+    serialize_container)
 from arraycontext.container.traversal import rec_keyed_map_array_container
 from arraycontext.context import ArrayT
 from arraycontext.impl.pytato import (
     PytatoJAXArrayContext, PytatoPyOpenCLArrayContext, _BasePytatoArrayContext)
 
 
+if TYPE_CHECKING:
+    from arraycontext.impl.pyopencl.taggable_cl_array import Axis as ClAxis
+
+
 logger = logging.getLogger(__name__)
 
 
@@ -107,6 +115,11 @@ class LeafArrayDescriptor(AbstractInputDescriptor):
 
 # {{{ utilities
 
+# Cheaper than np.isscalar on the per-call path of compiled functions.
+_SCALAR_TYPES = (int, float, complex, np.generic)
+
+
+@lru_cache(maxsize=None)
 def _ary_container_key_stringifier(keys: Tuple[Any, ...]) -> str:
     """
     Helper for :meth:`BaseLazilyCompilingFunctionCaller.__call__`. Stringifies an
@@ -129,13 +142,81 @@ def _ary_container_key_stringifier(keys: Tuple[Any, ...]) -> str:
     return "_".join(_rec_str(key) for key in keys)
 
 
+@lru_cache(maxsize=None)
+def _get_input_arg_id_str(arg_id: Tuple[Any, ...]) -> str:
+    """
+    Helper for :meth:`BaseLazilyCompilingFunctionCaller.__call__`. Returns the
+    name of the placeholder corresponding to the input id *arg_id*.
+    """
+    return sys.intern("_actx_in_" + _ary_container_key_stringifier(arg_id))
+
+
+@lru_cache(maxsize=None)
+def _get_output_arg_id_str(arg_id: Tuple[Any, ...]) -> str:
+    """
+    Helper for :meth:`BaseLazilyCompilingFunctionCaller.__call__`. Returns the
+    name of the output array corresponding to the output id *arg_id*.
+    """
+    return sys.intern("_pt_out_" + _ary_container_key_stringifier(arg_id))
+
+
+def _iter_keyed_leaves(
+        ary: ArrayContainer) -> Iterator[Tuple[Tuple[Any, ...], Any]]:
+    """
+    Helper for :func:`_get_arg_id_to_arg_and_arg_id_to_descr`. Yields
+    ``(keys, leaf)`` for every leaf array of *ary*, in the same order and with
+    the same keys as :func:`~arraycontext.rec_keyed_map_array_container`. Unlike
+    the latter, the containers are traversed with an explicit stack and are
+    not rebuilt along the way.
+    """
+    stack: List[Tuple[Tuple[Any, ...], Any]] = [((), ary)]
+    while stack:
+        keys, subary = stack.pop()
+        try:
+            iterable = serialize_container(subary)
+        except NotAnArrayContainerError:
+            yield keys, subary
+        else:
+            stack.extend(reversed([(keys + (key,), subsubary)
+                                   for key, subsubary in iterable]))
+
+
+def _record_arg_ids(kw: Any, arg: Any,
+                    arg_id_to_arg: Dict[Tuple[Any, ...], Any],
+                    arg_id_to_descr: Dict[Tuple[Any, ...], AbstractInputDescriptor]
+                    ) -> None:
+    """
+    Helper for :func:`_get_arg_id_to_arg_and_arg_id_to_descr`. Records the
+    argument *arg* passed as positional index or keyword *kw* (or its leaves,
+    for an array container) in *arg_id_to_arg* and *arg_id_to_descr*.
+    """
+    if isinstance(arg, _SCALAR_TYPES):
+        arg_id = (kw,)
+        arg_id_to_arg[arg_id] = arg
+        arg_id_to_descr[arg_id] = ScalarInputDescriptor(np.dtype(type(arg)))
+    elif is_array_container_type(arg.__class__):
+        for keys, ary in _iter_keyed_leaves(arg):
+            arg_id = (kw,) + keys
+            arg_id_to_arg[arg_id] = ary
+            arg_id_to_descr[arg_id] = LeafArrayDescriptor(
+                    np.dtype(ary.dtype), ary.shape)
+    elif isinstance(arg, pt.Array):
+        arg_id = (kw,)
+        arg_id_to_arg[arg_id] = arg
+        arg_id_to_descr[arg_id] = LeafArrayDescriptor(np.dtype(arg.dtype),
+                                                      arg.shape)
+    else:
+        raise ValueError("Argument to a compiled operator should be"
+                         " either a scalar, pt.Array or an array container. Got"
+                         f" '{arg}'.")
+
+
 def _get_arg_id_to_arg_and_arg_id_to_descr(args: Tuple[Any, ...],
                                            kwargs: Mapping[str, Any]
-                                           ) -> "Tuple[PMap[Tuple[Any, ...],\
-                                                            Any],\
-                                                       PMap[Tuple[Any, ...],\
-                                                            AbstractInputDescriptor]\
-                                                       ]":
+                                           ) -> Tuple[
+                                               Dict[Tuple[Any, ...], Any],
+                                               Dict[Tuple[Any, ...],
+                                                    AbstractInputDescriptor]]:
     """
     Helper for :meth:`BaseLazilyCompilingFunctionCaller.__call__`. Extracts
     mappings from argument id to argument values and from argument id to
@@ -146,32 +227,12 @@ def _get_arg_id_to_arg_and_arg_id_to_descr(args: Tuple[Any, ...],
     arg_id_to_arg: Dict[Tuple[Any, ...], Any] = {}
     arg_id_to_descr: Dict[Tuple[Any, ...], AbstractInputDescriptor] = {}
 
-    for kw, arg in itertools.chain(enumerate(args),
-                                   kwargs.items()):
-        if np.isscalar(arg):
-            arg_id = (kw,)
-            arg_id_to_arg[arg_id] = arg
-            arg_id_to_descr[arg_id] = ScalarInputDescriptor(np.dtype(type(arg)))
-        elif is_array_container_type(arg.__class__):
-            def id_collector(keys, ary):
-                arg_id = (kw,) + keys  # noqa: B023
-                arg_id_to_arg[arg_id] = ary  # noqa: B023
-                arg_id_to_descr[arg_id] = LeafArrayDescriptor(  # noqa: B023
-                        np.dtype(ary.dtype), ary.shape)
-                return ary
-
-            rec_keyed_map_array_container(id_collector, arg)
-        elif isinstance(arg, pt.Array):
-            arg_id = (kw,)
-            arg_id_to_arg[arg_id] = arg
-            arg_id_to_descr[arg_id] = LeafArrayDescriptor(np.dtype(arg.dtype),
-                                                          arg.shape)
-        else:
-            raise ValueError("Argument to a compiled operator should be"
-                             " either a scalar, pt.Array or an array container. Got"
-                             f" '{arg}'.")
+    for iarg, arg in enumerate(args):
+        _record_arg_ids(iarg, arg, arg_id_to_arg, arg_id_to_descr)
+    for kw, arg in kwargs.items():
+        _record_arg_ids(kw, arg, arg_id_to_arg, arg_id_to_descr)
 
-    return pmap(arg_id_to_arg), pmap(arg_id_to_descr)
+    return arg_id_to_arg, arg_id_to_descr
 
 
 def _to_input_for_compiled(ary: ArrayT, actx: PytatoPyOpenCLArrayContext):
@@ -208,36 +269,47 @@ def _to_input_for_compiled(ary: ArrayT, actx: PytatoPyOpenCLArrayContext):
         raise NotImplementedError(type(ary))
 
 
-def _get_f_placeholder_args(arg, kw, arg_id_to_name, actx):
+def _leaf_to_placeholder(kw, arg_id_to_name, actx, keys, ary):
+    """
+    Helper for :func:`_get_f_placeholder_args`. Returns the placeholder for the
+    leaf array *ary* found at *keys* within the argument *kw*, and records its
+    name in *arg_id_to_name*.
+    """
+    arg_id = (kw,) + keys
+    name = arg_id_to_name[arg_id] = _get_input_arg_id_str(arg_id)
+    # Transform the DAG to give metadata inference a chance to do its job
+    ary = _to_input_for_compiled(ary, actx)
+    return pt.make_placeholder(name, ary.shape, ary.dtype,
+                               axes=ary.axes,
+                               tags=ary.tags)
+
+
+def _get_f_placeholder_args(arg, kw, arg_id_to_descr, arg_id_to_name, actx):
     """
     Helper for :class:`BaseLazilyCompilingFunctionCaller.__call__`. Returns the
     placeholder version of an argument to
-    :attr:`BaseLazilyCompilingFunctionCaller.f`.
+    :attr:`BaseLazilyCompilingFunctionCaller.f`. The name of every created
+    placeholder is recorded in *arg_id_to_name* as it is generated, so that
+    names and placeholders are produced in the same traversal of *arg*.
+
+    *arg_id_to_descr* is as returned by
+    :func:`_get_arg_id_to_arg_and_arg_id_to_descr` and is used to tell the
+    kind of *arg* without classifying it again: a scalar or a
+    :class:`pytato.Array` has a descriptor for the argument id ``(kw,)``,
+    whereas for an array container only its leaves do.
     """
-    if np.isscalar(arg):
-        name = arg_id_to_name[(kw,)]
-        return pt.make_placeholder(name, (), np.dtype(type(arg)))
-    elif isinstance(arg, pt.Array):
-        name = arg_id_to_name[(kw,)]
-        # Transform the DAG to give metadata inference a chance to do its job
-        arg = _to_input_for_compiled(arg, actx)
-        return pt.make_placeholder(name, arg.shape, arg.dtype,
-                                   axes=arg.axes,
-                                   tags=arg.tags)
-    elif is_array_container_type(arg.__class__):
-        def _rec_to_placeholder(keys, ary):
-            name = arg_id_to_name[(kw,) + keys]
-            # Transform the DAG to give metadata inference a chance to do its job
-            ary = _to_input_for_compiled(ary, actx)
-            return pt.make_placeholder(name,
-                                       ary.shape,
-                                       ary.dtype,
-                                       axes=ary.axes,
-                                       tags=ary.tags)
-
-        return rec_keyed_map_array_container(_rec_to_placeholder, arg)
+    arg_id = (kw,)
+    descr = arg_id_to_descr.get(arg_id)
+
+    if isinstance(descr, ScalarInputDescriptor):
+        name = arg_id_to_name[arg_id] = _get_input_arg_id_str(arg_id)
+        return pt.make_placeholder(name, (), descr.dtype)
+    elif isinstance(descr, LeafArrayDescriptor):
+        return _leaf_to_placeholder(kw, arg_id_to_name, actx, (), arg)
     else:
-        raise NotImplementedError(type(arg))
+        assert descr is None
+        return rec_keyed_map_array_container(
+                partial(_leaf_to_placeholder, kw, arg_id_to_name, actx), arg)
 
 # }}}
 
@@ -259,8 +331,9 @@ class BaseLazilyCompilingFunctionCaller:
 
     actx: _BasePytatoArrayContext
     f: Callable[..., Any]
-    program_cache: Dict["PMap[Tuple[Any, ...], AbstractInputDescriptor]",
-                        "CompiledFunction"] = field(default_factory=lambda: {})
+    program_cache: Dict[
+            FrozenSet[Tuple[Tuple[Any, ...], AbstractInputDescriptor]],
+            "CompiledFunction"] = field(default_factory=lambda: {})
 
     # {{{ abstract interface
 
@@ -320,9 +393,12 @@ class BaseLazilyCompilingFunctionCaller:
         """
         arg_id_to_arg, arg_id_to_descr = _get_arg_id_to_arg_and_arg_id_to_descr(
             args, kwargs)
+        # order-insensitive, so that passing keyword arguments in a different
+        # order does not trigger a retrace
+        program_cache_key = frozenset(arg_id_to_descr.items())
 
         try:
-            compiled_f = self.program_cache[arg_id_to_descr]
+            compiled_f = self.program_cache[program_cache_key]
         except KeyError:
             pass
         else:
@@ -330,15 +406,15 @@ class BaseLazilyCompilingFunctionCaller:
 
         dict_of_named_arrays = {}
         output_id_to_name_in_program = {}
-        input_id_to_name_in_program = {
-            arg_id: f"_actx_in_{_ary_container_key_stringifier(arg_id)}"
-            for arg_id in arg_id_to_arg}
+
+        # filled in by _get_f_placeholder_args while building the placeholders
+        input_id_to_name_in_program: Dict[Tuple[Any, ...], str] = {}
 
         output_template = self.f(
-                *[_get_f_placeholder_args(arg, iarg,
+                *[_get_f_placeholder_args(arg, iarg, arg_id_to_descr,
                                           input_id_to_name_in_program, self.actx)
                     for iarg, arg in enumerate(args)],
-                **{kw: _get_f_placeholder_args(arg, kw,
+                **{kw: _get_f_placeholder_args(arg, kw, arg_id_to_descr,
                                                input_id_to_name_in_program,
                                                self.actx)
                     for kw, arg in kwargs.items()})
@@ -354,22 +430,31 @@ class BaseLazilyCompilingFunctionCaller:
                 "did not return an array container or pt.Array,"
                 f" but an instance of '{output_template.__class__}' instead.")
 
-        def _as_dict_of_named_arrays(keys, ary):
-            name = "_pt_out_" + _ary_container_key_stringifier(keys)
-            output_id_to_name_in_program[keys] = name
-            dict_of_named_arrays[name] = ary
-            return ary
+        if isinstance(output_template, pt.Array):
+            # A single output array needs no container template to be
+            # rebuilt from the program's outputs on every call.
+            compiled_func = self._dag_to_compiled_func(
+                    output_template,
+                    input_id_to_name_in_program=input_id_to_name_in_program,
+                    output_id_to_name_in_program=None,
+                    output_template=None)
+        else:
+            def _as_dict_of_named_arrays(keys, ary):
+                name = _get_output_arg_id_str(keys)
+                output_id_to_name_in_program[keys] = name
+                dict_of_named_arrays[name] = ary
+                return ary
 
-        rec_keyed_map_array_container(_as_dict_of_named_arrays,
-                                      output_template)
+            rec_keyed_map_array_container(_as_dict_of_named_arrays,
+                                          output_template)
 
-        compiled_func = self._dag_to_compiled_func(
-                pt.make_dict_of_named_arrays(dict_of_named_arrays),
-                input_id_to_name_in_program=input_id_to_name_in_program,
-                output_id_to_name_in_program=output_id_to_name_in_program,
-                output_template=output_template)
+            compiled_func = self._dag_to_compiled_func(
+                    pt.make_dict_of_named_arrays(dict_of_named_arrays),
+                    input_id_to_name_in_program=input_id_to_name_in_program,
+                    output_id_to_name_in_program=output_id_to_name_in_program,
+                    output_template=output_template)
 
-        self.program_cache[arg_id_to_descr] = compiled_func
+        self.program_cache[program_cache_key] = compiled_func
         return compiled_func(arg_id_to_arg)
 
 # }}}
@@ -403,12 +488,11 @@ class LazilyPyOpenCLCompilingFunctionCaller(BaseLazilyCompilingFunctionCaller):
         self.actx._compile_trace_callback(
                 prg_id, "post_transform_dag", pt_dict_of_named_arrays)
 
-        name_in_program_to_tags = {
-            name: out.tags
-            for name, out in pt_dict_of_named_arrays._data.items()}
-        name_in_program_to_axes = {
-            name: out.axes
-            for name, out in pt_dict_of_named_arrays._data.items()}
+        name_in_program_to_tags = {}
+        name_in_program_to_axes = {}
+        for name, out in pt_dict_of_named_arrays._data.items():
+            name_in_program_to_tags[name] = out.tags
+            name_in_program_to_axes[name] = out.axes
 
         self.actx._compile_trace_callback(
                 prg_id, "pre_generate_loopy", pt_dict_of_named_arrays)
@@ -499,12 +583,11 @@ class LazilyJAXCompilingFunctionCaller(BaseLazilyCompilingFunctionCaller):
         self.actx._compile_trace_callback(
                 prg_id, "post_transform_dag", pt_dict_of_named_arrays)
 
-        name_in_program_to_tags = {
-            name: out.tags
-            for name, out in pt_dict_of_named_arrays._data.items()}
-        name_in_program_to_axes = {
-            name: out.axes
-            for name, out in pt_dict_of_named_arrays._data.items()}
+        name_in_program_to_tags = {}
+        name_in_program_to_axes = {}
+        for name, out in pt_dict_of_named_arrays._data.items():
+            name_in_program_to_tags[name] = out.tags
+            name_in_program_to_axes[name] = out.axes
 
         self.actx._compile_trace_callback(
                 prg_id, "pre_generate_jax", pt_dict_of_named_arrays)
@@ -525,7 +608,7 @@ def _args_to_device_buffers(actx, input_id_to_name_in_program, arg_id_to_arg):
     input_kwargs_for_loopy = {}
 
     for arg_id, arg in arg_id_to_arg.items():
-        if np.isscalar(arg):
+        if isinstance(arg, _SCALAR_TYPES):
             if isinstance(actx, PytatoPyOpenCLArrayContext):
                 import pyopencl.array as cla
                 arg = cla.to_device(actx.queue, np.array(arg),
@@ -631,8 +714,27 @@ class CompiledPyOpenCLFunctionReturningArrayContainer(CompiledFunction):
     name_in_program_to_axes: Mapping[str, Tuple[pt.Axis, ...]]
     output_template: ArrayContainer
 
-    def __call__(self, arg_id_to_arg) -> ArrayContainer:
+    @memoize_method
+    def _get_output_id_to_name_axes_and_tags(self) -> Mapping[
+            Tuple[Any, ...], Tuple[str, "Tuple[ClAxis, ...]", FrozenSet[Tag]]]:
+        """
+        Returns a mapping from output id to the name of the output array in
+        :attr:`CompiledFunction.pytato_program` along with the axes and tags
+        to attach to it. These are the same for every call, so they are only
+        computed once.
+        """
         from .utils import get_cl_axes_from_pt_axes
+
+        return {
+            output_id: (
+                name_in_program,
+                get_cl_axes_from_pt_axes(
+                    self.name_in_program_to_axes[name_in_program]),
+                self.name_in_program_to_tags[name_in_program])
+            for output_id, name_in_program
+            in self.output_id_to_name_in_program.items()}
+
+    def __call__(self, arg_id_to_arg) -> ArrayContainer:
         from arraycontext.impl.pyopencl.taggable_cl_array import to_tagged_cl_array
 
         input_kwargs_for_loopy = _args_to_device_buffers(
@@ -647,13 +749,13 @@ class CompiledPyOpenCLFunctionReturningArrayContainer(CompiledFunction):
         # running out of memory. This mitigates that risk a bit, for now.
         evt.wait()
 
+        output_id_to_name_axes_and_tags = (
+            self._get_output_id_to_name_axes_and_tags())
+
         def to_output_template(keys, _):
-            name_in_program = self.output_id_to_name_in_program[keys]
+            name_in_program, axes, tags = output_id_to_name_axes_and_tags[keys]
             return self.actx.thaw(to_tagged_cl_array(
-                out_dict[name_in_program],
-                axes=get_cl_axes_from_pt_axes(
-                    self.name_in_program_to_axes[name_in_program]),
-                tags=self.name_in_program_to_tags[name_in_program]))
+                out_dict[name_in_program], axes=axes, tags=tags))
 
         return rec_keyed_map_array_container(to_output_template,
                                              self.output_template)
@@ -757,9 +859,9 @@ class CompiledJAXFunctionReturningArray(CompiledFunction):
         input_kwargs_for_loopy = _args_to_device_buffers(
                 self.actx, self.input_id_to_name_in_program, arg_id_to_arg)
 
-        evt, out_dict = self.pytato_program(**input_kwargs_for_loopy)
+        out_dict = self.pytato_program(**input_kwargs_for_loopy)
 
-        return self.actx.thaw(out_dict[self.output_name])
+        return self.actx.thaw(out_dict[self.output_name].block_until_ready())
 
 # }}}
 
@@ -125,6 +125,31 @@ def test_arg_size_limit(actx_factory):
     assert ran_callback
 
 
+def test_compile_traces_once_per_signature(actx_factory):
+    ntraces = 0
+
+    def my_ctc(what, stage, ir):
+        if stage == "post_trace":
+            nonlocal ntraces
+            ntraces += 1
+
+    def twice(x):
+        return 2 * x
+
+    actx = _PytatoPyOpenCLArrayContextForTests(
+        actx_factory().queue, compile_trace_callback=my_ctc)
+
+    import numpy as np
+
+    f = actx.compile(twice)
+    for _ in range(3):
+        f(actx.thaw(actx.freeze(actx.from_numpy(np.ones(10)))))
+    assert ntraces == 1
+
+    f(actx.thaw(actx.freeze(actx.from_numpy(np.ones(12)))))
+    assert ntraces == 2
+
+
 @pytest.mark.parametrize("pass_allocator", ["auto_none", "auto_true", "auto_false",
                                             "pass_buffer", "pass_svm",
                                             "pass_buffer_pool", "pass_svm_pool"])